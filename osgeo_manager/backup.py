@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import hashlib
+import json
+import os
+import time
+
+from .constants import BACKUP_JOURNAL_DIR, BACKUP_JOURNAL_MAX_AGE
+from .os_utils import create_direcotry
+
+PRIVATE_PERMISSION = 0o700
+PRIVATE_FILE_PERMISSION = 0o600
+
+
+class BackupJournal(object):
+    META = 'meta'
+    COPY = 'copy'
+    STYLES = 'styles'
+
+    def __init__(self, dest_path=None):
+        # kept out of the published directory, backups to the default
+        # location share one journal so they can be resumed as well
+        key = 'portal' if not dest_path else hashlib.sha1(
+            os.path.abspath(dest_path).encode('utf-8')).hexdigest()
+        self._ensure_private_dir(BACKUP_JOURNAL_DIR)
+        self.path = os.path.join(BACKUP_JOURNAL_DIR, key + '.json')
+        # collected layer rows are appended here, one json document per line
+        self.rows_path = os.path.join(BACKUP_JOURNAL_DIR, key + '.rows.jsonl')
+        self.lock_path = os.path.join(BACKUP_JOURNAL_DIR, key + '.lock')
+        self._lock = None
+        self.state = {}
+
+    def acquire(self):
+        # a single backup may use a journal at a time, the lock is dropped
+        # by the kernel as well if the process dies
+        lock = self._open_private(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock.close()
+            raise Exception('another backup to this destination is running')
+        self._lock = lock
+        self.state = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.state = json.load(f)
+
+    def release(self):
+        if self._lock:
+            fcntl.flock(self._lock.fileno(), fcntl.LOCK_UN)
+            self._lock.close()
+            self._lock = None
+
+    @staticmethod
+    def _ensure_private_dir(path):
+        # the journal holds every SLD body and decides which files the
+        # backup writes and removes, nobody else may touch it
+        create_direcotry(path, mode=PRIVATE_PERMISSION)
+        info = os.lstat(path)
+        if not os.path.isdir(path) or os.path.islink(path) or \
+                info.st_uid != os.getuid():
+            raise Exception(
+                '{} is not a directory owned by this user'.format(path))
+        os.chmod(path, PRIVATE_PERMISSION)
+
+    @staticmethod
+    def _open_private(path, mode):
+        flags = os.O_WRONLY | os.O_CREAT
+        flags |= os.O_APPEND if 'a' in mode else os.O_TRUNC
+        return os.fdopen(os.open(path, flags, PRIVATE_FILE_PERMISSION), mode)
+
+    @property
+    def dest_path(self):
+        return self.state.get('dest_path', None)
+
+    @property
+    def package_path(self):
+        return self.state.get('package_path', None)
+
+    @property
+    def last_pk(self):
+        return self.state.get('last_pk', None)
+
+    def iter_layers(self):
+        if not os.path.isfile(self.rows_path):
+            return
+        with open(self.rows_path, 'rb') as f:
+            # rows past rows_size belong to a chunk that was interrupted
+            for line in iter(f.readline, b''):
+                if f.tell() > self.state.get('rows_size', 0):
+                    break
+                yield tuple(json.loads(line.decode('utf-8')))
+
+    def add_layers(self, layers, last_pk):
+        with self._open_private(self.rows_path, 'ab') as f:
+            # drop rows of a chunk that was interrupted before being saved
+            f.truncate(self.state.get('rows_size', 0))
+            for layer in layers:
+                f.write((json.dumps(layer) + '\n').encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+            self.state['rows_size'] = f.tell()
+        self.state['last_pk'] = last_pk
+        self.save()
+
+    def stale(self):
+        started = self.state.get('started', 0)
+        return time.time() - started > BACKUP_JOURNAL_MAX_AGE
+
+    def done(self, stage):
+        return stage in self.state.get('completed', [])
+
+    def start(self, dest_path, package_path):
+        self._remove(self.rows_path)
+        self.state = {
+            'dest_path': dest_path,
+            'package_path': package_path,
+            'completed': [],
+            'rows_size': 0,
+            'started': time.time(),
+        }
+        self.save()
+
+    def complete(self, stage, **data):
+        self.state.update(data)
+        self.state['completed'].append(stage)
+        self.save()
+
+    def save(self):
+        # write then rename so an interruption never leaves half a journal
+        tmp_path = self.path + '.tmp'
+        with self._open_private(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _remove(path):
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def finish(self):
+        self._remove(self.rows_path)
+        self._remove(self.path)
+        self.state = {}
@@ -1,97 +1,160 @@
 # -*- coding: utf-8 -*-
 try:
-    import ogr
+    import gdal
 except ImportError:
-    from osgeo import ogr
+    from osgeo import gdal
 import os
-import pipes
-import subprocess
+import shutil
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 
+from django.db.models import Prefetch
 from geonode.geoserver.helpers import ogc_server_settings
-from geonode.layers.models import Layer
+from geonode.layers.models import Attribute, Layer
 
-from .constants import DOWNLOADS_DIR_PATH, POSTGIS_OPTIONS
+from .backup import BackupJournal
+from .constants import (COPY_LAYER_WORKERS, DOWNLOADS_DIR_PATH,
+                        GDAL_CONFIG_OPTIONS, LAYERS_CHUNK_SIZE, PGBOUNCER,
+                        POSTGIS_OPTIONS, SLD_FETCH_WORKERS, TEMP_DIR_PATH)
 from .exceptions import OSGEOLayerException, SourceException
 from .layers import OSGEOLayer
 from .log import get_logger
 from .mixins import OSGEOManagerMixin
-from .os_utils import get_new_dir
+from .os_utils import create_direcotry, get_new_dir
 from .styles import StyleManager
-from .utils import get_sld_body
+from .utils import get_sld_body, is_postgres_source, launder_pg_name
 
 logger = get_logger(__name__)
 
+for option, value in GDAL_CONFIG_OPTIONS.items():
+    # don't override what the environment already configured
+    if gdal.GetConfigOption(option) is None:
+        gdal.SetConfigOption(option, value)
+
 
 class OSGEOManager(OSGEOManagerMixin):
     def __init__(self, package_path):
         self.path = package_path
+        self.source = None
+        self._layer_names = None
         self.get_source()
 
     def get_source(self):
-        with self.open_source(self.path) as source:
-            self.source = source
+        if self.source is None:
+            self.source = self.open_source(self.path).source
         return self.source
 
+    def close(self):
+        if self.source:
+            self.source.FlushCache()
+        self.source = None
+        self._layer_names = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def check_schema_geonode(self, layername, glayername, ignore_case=False):
         gpkg_layer = self.get_layer_by_name(layername)
-        glayer = Layer.objects.get(alternate=glayername)
         if not gpkg_layer:
             raise SourceException("Cannot find this layer in Source")
-        geonode_manager = OSGEOManager(get_connection(), is_postgis=True)
-        glayer = geonode_manager.get_layer_by_name(glayername.split(":").pop())
-        if not glayer:
-            raise OSGEOLayerException(
-                "Layer {} Cannot be found in Source".format(glayername))
-        check = OSGEOManager.compare_schema(gpkg_layer, glayer, ignore_case)
+        # a fresh source every check, OGR keeps the layer definition it read
+        # first and the table may have been altered since
+        with OSGEOManager(get_connection()) as geonode_manager:
+            glayer = geonode_manager.get_layer_by_name(
+                glayername.split(":").pop())
+            if not glayer:
+                raise OSGEOLayerException(
+                    "Layer {} Cannot be found in Source".format(glayername))
+            check = OSGEOManager.compare_schema(gpkg_layer, glayer,
+                                                ignore_case)
         return check
 
+    @property
+    def layer_names(self):
+        # rebuilt when the layer count changes, _get_source_layer
+        # also drops it when an index no longer matches its name
+        source = self.get_source()
+        if self._layer_names is None or \
+                len(self._layer_names) != source.GetLayerCount():
+            self._layer_names = self.get_source_layer_names(source)
+        return self._layer_names
+
+    def _get_source_layer(self, layername):
+        if is_postgres_source(self.path):
+            # building the index loads every table definition of the
+            # database, a single lookup by name is far cheaper there
+            return self.get_source().GetLayerByName(layername)
+        index = self.layer_names.get(layername)
+        if index is not None:
+            layer = self.source.GetLayer(index)
+            if layer is not None and layer.GetName() == layername:
+                return layer
+            # layers were deleted and added since the index was built
+            self._layer_names = None
+        # not every table is listed, e.g. non spatial PostGIS tables
+        return self.source.GetLayerByName(layername)
+
     def layer_exists(self, layername):
-        return OSGEOManager.source_layer_exists(self.source, layername)
+        return self._get_source_layer(layername) is not None
 
     def get_layers(self):
-        return self.get_source_layers(self.source)
+        return self.get_source_layers(self.get_source())
 
     def get_layernames(self):
         return tuple(layer.name for layer in self.get_layers())
 
     def get_layer_by_name(self, layername):
-        if self.layer_exists(layername):
-            return OSGEOLayer(
-                self.source.GetLayerByName(layername), self.source)
-        return None
+        layer = self._get_source_layer(layername)
+        return OSGEOLayer(layer, self.source) if layer is not None else None
 
     def read_schema(self):
-        return self.read_source_schema(self.source)
+        return self.read_source_schema(self.get_source())
 
     def get_features(self):
         return self.get_layers_features(self.get_layers())
 
-    def _cmd_lyr_postgis(self,
-                         gpkg_path,
-                         connectionString,
-                         layername,
-                         options=POSTGIS_OPTIONS._asdict()):
+    def get_arrow_batches(self, batch_size=65536, read_geometry=True):
+        return self.get_layers_arrow_batches(
+            self.get_layers(),
+            batch_size=batch_size,
+            read_geometry=read_geometry)
 
+    @staticmethod
+    def _postgis_access_mode(options=POSTGIS_OPTIONS._asdict()):
         overwrite = options.get('overwrite', POSTGIS_OPTIONS.overwrite)
-        skipfailures = options.get('skipfailures',
-                                   POSTGIS_OPTIONS.skipfailures)
         append_layer = options.get('append', POSTGIS_OPTIONS.append)
         update_layer = options.get('update', POSTGIS_OPTIONS.update)
-        command = """ogr2ogr {} {} {} -f "PostgreSQL" PG:"{}" {} {}  {} """\
-            .format("-overwrite" if overwrite else "",
-                    "-update" if update_layer else "",
-                    "-append" if append_layer else "",
-                    connectionString,
-                    gpkg_path, "-skipfailures" if skipfailures else "",
-                    pipes.quote(layername))
-        return command
-
-    def execute(self, cmd):
-        p = subprocess.Popen(
-            cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = p.communicate()
-        return out, err
+        # same precedence ogr2ogr applies when several flags are given
+        if append_layer:
+            return 'append'
+        elif overwrite:
+            return 'overwrite'
+        elif update_layer:
+            return 'update'
+        return None
+
+    def _postgis_translate_options(self,
+                                   layername,
+                                   options=POSTGIS_OPTIONS._asdict()):
+        skipfailures = options.get('skipfailures',
+                                   POSTGIS_OPTIONS.skipfailures)
+        return gdal.VectorTranslateOptions(
+            format="PostgreSQL",
+            accessMode=self._postgis_access_mode(options),
+            skipFailures=skipfailures,
+            layers=[layername])
+
+    @staticmethod
+    def _pg_feature_count(ds, layername):
+        # the layer may have been laundered on its way into PostgreSQL
+        layer = ds.GetLayerByName(layername) or \
+            ds.GetLayerByName(launder_pg_name(layername))
+        return layer.GetFeatureCount() if layer else 0
 
     def layer_to_postgis(self,
                          layername,
@@ -101,9 +164,11 @@ class OSGEOManager(OSGEOManagerMixin):
                          launder=False,
                          name=None):
         with self.open_source(connectionString) as source:
-            layer = self.source.GetLayerByName(layername)
+            layer = self._get_source_layer(layername)
             assert layer
             layer = OSGEOLayer(layer, source)
+            # the destination may be this very source
+            self._layer_names = None
             return layer.copy_to_source(
                 source,
                 overwrite=overwrite,
@@ -112,73 +177,236 @@ class OSGEOManager(OSGEOManagerMixin):
                 name=name)
 
     def layer_to_postgis_cmd(self, layername, connectionString, options=None):
-        cmd = self._cmd_lyr_postgis(
-            self.path,
-            connectionString,
-            layername,
-            options=options if options else POSTGIS_OPTIONS._asdict())
-        out, err = self.execute(cmd)
+        options = options if options else POSTGIS_OPTIONS._asdict()
+        translate_options = self._postgis_translate_options(
+            layername, options=options)
+        gdal.ErrorReset()
+        gdal.PushErrorHandler('CPLQuietErrorHandler')
+        try:
+            # rows already in the table don't count as written
+            existing = 0
+            if self._postgis_access_mode(options) in ('append', 'update'):
+                dest = gdal.OpenEx(connectionString, gdal.OF_VECTOR)
+                if dest:
+                    existing = self._pg_feature_count(dest, layername)
+                dest = None
+                gdal.ErrorReset()
+            # srcDS must be a path or a gdal.Dataset, not the ogr source
+            ds = gdal.VectorTranslate(
+                connectionString, self.path, options=translate_options)
+        finally:
+            gdal.PopErrorHandler()
+        err = gdal.GetLastErrorMsg() or None
+        self._layer_names = None
+        out = None
+        if ds:
+            out = self._pg_feature_count(ds, layername) - existing
+            ds = None
         if not err:
             logger.warning("{} Added Successfully".format(layername))
+        return out, err
+
+    @staticmethod
+    def _layer_as_gpkg(connectionString, layername, dest_path):
+        # every worker reads through its own connection, OGR handles
+        # can't be shared between threads
+        gdal.ErrorReset()
+        ds = gdal.VectorTranslate(
+            dest_path,
+            connectionString,
+            options=gdal.VectorTranslateOptions(
+                format='GPKG', layers=[layername]))
+        if not ds:
+            raise SourceException("Cannot copy layer {}: {}".format(
+                layername, gdal.GetLastErrorMsg()))
+        ds = None
+        return dest_path
 
     @staticmethod
     def postgis_as_gpkg(connectionString, dest_path, layernames=None):
         if not dest_path.endswith(".gpkg"):
             dest_path += ".gpkg"
         with OSGEOManager.open_source(connectionString) as postgis_source:
-            ds = ogr.GetDriverByName('GPKG').CreateDataSource(dest_path)
-            layers = OSGEOManager.get_source_layers(postgis_source) \
-                if not layernames \
-                else [layer for layer in
-                      OSGEOManager.get_source_layers(postgis_source)
-                      if layer and layer.name in layernames]
-            for lyr in layers:
-                ds.CopyLayer(lyr.gpkg_layer, lyr.name)
+            if not postgis_source:
+                raise SourceException("Can't open the source")
+            names = [
+                layer.name
+                for layer in OSGEOManager.get_source_layers(postgis_source)
+                if not layernames or layer.name in layernames
+            ]
+        gdal.ErrorReset()
+        ds = gdal.GetDriverByName('GPKG').Create(dest_path, 0, 0, 0,
+                                                 gdal.GDT_Unknown)
+        if not ds:
+            raise SourceException("Cannot create {}: {}".format(
+                dest_path, gdal.GetLastErrorMsg()))
+        if names:
+            # a single flat directory, removed below without leaving the
+            # empty timestamp tree get_new_dir would create behind
+            create_direcotry(TEMP_DIR_PATH)
+            tmp_dir = tempfile.mkdtemp(dir=TEMP_DIR_PATH)
+            tmp_paths = [
+                os.path.join(tmp_dir, "{}.gpkg".format(i))
+                for i in range(len(names))
+            ]
+            merge_options = gdal.VectorTranslateOptions(accessMode='update')
+            try:
+                with ThreadPoolExecutor(max_workers=min(
+                        COPY_LAYER_WORKERS, len(names))) as executor:
+                    # only this thread writes to the destination package
+                    for name, tmp_path in zip(
+                            names,
+                            executor.map(OSGEOManager._layer_as_gpkg,
+                                         repeat(connectionString), names,
+                                         tmp_paths)):
+                        gdal.ErrorReset()
+                        if not gdal.VectorTranslate(
+                                ds, tmp_path, options=merge_options):
+                            raise SourceException(
+                                "Cannot merge layer {}: {}".format(
+                                    name, gdal.GetLastErrorMsg()))
+            finally:
+                shutil.rmtree(tmp_dir)
+        ds = None
         return dest_path
 
     @staticmethod
-    def backup_portal(dest_path=None):
+    def _collect_layer_meta(layer):
+        table_name = str(layer.alternate).split(":").pop()
+        layer_style = layer.default_style
+        return (table_name, str(layer.gml_attrs[0].attribute),
+                str(layer_style.name), get_sld_body(layer_style.sld_url))
+
+    @staticmethod
+    def _iter_layer_chunks(queryset, chunk_size=LAYERS_CHUNK_SIZE,
+                           last_pk=None):
+        # keyset pagination instead of iterator(chunk_size=...),
+        # iterator() ignores prefetch_related before Django 4.1
+        queryset = queryset.order_by('pk')
+        while True:
+            if last_pk is not None:
+                chunk = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+            else:
+                chunk = list(queryset[:chunk_size])
+            if not chunk:
+                break
+            yield chunk
+            last_pk = chunk[-1].pk
+
+    @staticmethod
+    def _collect_layers_meta(source, journal):
+        all_layers = Layer.objects.select_related(
+            'default_style').prefetch_related(
+                Prefetch(
+                    'attribute_set',
+                    queryset=Attribute.objects.filter(
+                        attribute_type__contains='gml'),
+                    to_attr='gml_attrs'))
+        layer_names = OSGEOManager.get_source_layer_names(source)
+        with ThreadPoolExecutor(max_workers=SLD_FETCH_WORKERS) as executor:
+            for chunk in OSGEOManager._iter_layer_chunks(
+                    all_layers, last_pk=journal.last_pk):
+                # the OGR source isn't thread safe, filter here
+                # and leave only the SLD downloads to the workers
+                layers = []
+                for layer in chunk:
+                    table_name = str(layer.alternate).split(":").pop()
+                    if table_name in layer_names or \
+                            OSGEOManager.source_layer_exists(
+                                source, table_name):
+                        layers.append(layer)
+                # drain the chunk before the next one is loaded
+                journal.add_layers(
+                    list(
+                        executor.map(OSGEOManager._collect_layer_meta,
+                                     layers)),
+                    last_pk=chunk[-1].pk)
+
+    @staticmethod
+    def _copy_tables(connection_string, package_path, table_names):
+        if os.path.exists(package_path):
+            # left over by an interrupted backup
+            os.remove(package_path)
+        return OSGEOManager.postgis_as_gpkg(
+            connection_string, package_path, layernames=table_names)
+
+    @staticmethod
+    def _write_styles(package_path, layer_styles):
+        stm = StyleManager(package_path)
+        stm.create_table()
+        # replace, rows of an interrupted earlier attempt may be there
+        stm.add_styles_bulk(layer_styles, default=True, replace=True)
+
+    @staticmethod
+    def _journal_is_valid(journal, dest_path=None):
+        journal_dest = journal.dest_path
+        if not journal_dest or not os.path.isdir(journal_dest):
+            # the unfinished backup was removed in the meantime
+            return False
+        journal_dest = os.path.realpath(journal_dest)
+        expected_dest = os.path.realpath(dest_path) if dest_path else None
+        if expected_dest and journal_dest != expected_dest:
+            return False
+        if not expected_dest and not journal_dest.startswith(
+                os.path.join(os.path.realpath(DOWNLOADS_DIR_PATH), '')):
+            return False
+        # the package is removed and rewritten, it must be ours
+        package_path = journal.package_path or ''
+        return package_path.endswith('.gpkg') and os.path.dirname(
+            os.path.realpath(package_path)) == journal_dest
+
+    @staticmethod
+    def backup_portal(dest_path=None, resume=True):
         final_path = None
-        if not dest_path:
-            dest_path = get_new_dir(base_dir=DOWNLOADS_DIR_PATH)
-        file_suff = time.strftime("%Y_%m_%d-%H_%M_%S")
-        package_dir = os.path.join(dest_path, "backup_%s.gpkg" % (file_suff))
         connection_string = get_connection()
+        journal = None
         try:
+            # resume an interrupted backup to the same destination
+            # (or to the default location) from its last completed stage,
+            # unless asked not to or it is too old to be trusted
+            journal = BackupJournal(dest_path)
+            journal.acquire()
+            if journal.state and (
+                    not resume or journal.stale() or
+                    not OSGEOManager._journal_is_valid(journal, dest_path)):
+                journal.finish()
+            if not dest_path:
+                dest_path = journal.dest_path or get_new_dir(
+                    base_dir=DOWNLOADS_DIR_PATH)
             if not os.path.isdir(dest_path) or not os.access(
                     dest_path, os.W_OK):
                 raise Exception(
                     'maybe destination is not writable or not a directory')
+            if not journal.package_path:
+                file_suff = time.strftime("%Y_%m_%d-%H_%M_%S")
+                journal.start(
+                    dest_path,
+                    os.path.join(dest_path, "backup_%s.gpkg" % (file_suff)))
+            package_dir = journal.package_path
             with OSGEOManager.open_source(connection_string) as ds:
                 if ds:
-                    all_layers = Layer.objects.all()
-                    layer_styles = []
-                    table_names = []
-                    for layer in all_layers:
-                        typename = str(layer.alternate)
-                        table_name = typename.split(":").pop()
-                        if OSGEOManager.source_layer_exists(ds, table_name):
-                            table_names.append(table_name)
-                            gattr = str(
-                                layer.attribute_set.filter(
-                                    attribute_type__contains='gml').first()
-                                .attribute)
-                            layer_style = layer.default_style
-                            sld_url = layer_style.sld_url
-                            style_name = str(layer_style.name)
-                            layer_styles.append((table_name, gattr, style_name,
-                                                 get_sld_body(sld_url)))
-                    OSGEOManager.postgis_as_gpkg(
-                        connection_string, package_dir, layernames=table_names)
-                    stm = StyleManager(package_dir)
-                    stm.create_table()
-                    for style in layer_styles:
-                        stm.add_style(*style, default=True)
+                    if not journal.done(BackupJournal.META):
+                        OSGEOManager._collect_layers_meta(ds, journal)
+                        journal.complete(BackupJournal.META)
+                    if not journal.done(BackupJournal.COPY):
+                        OSGEOManager._copy_tables(
+                            connection_string, package_dir,
+                            [layer[0] for layer in journal.iter_layers()])
+                        journal.complete(BackupJournal.COPY)
+                    if not journal.done(BackupJournal.STYLES):
+                        # streamed from the journal, SLD bodies are never
+                        # all held in memory at once
+                        OSGEOManager._write_styles(package_dir,
+                                                   journal.iter_layers())
+                        journal.complete(BackupJournal.STYLES)
+                    journal.finish()
             final_path = dest_path
 
         except Exception as e:
             logger.error(e)
         finally:
+            if journal:
+                journal.release()
             return final_path
 
 
@@ -189,4 +417,7 @@ def get_connection(database_name=None, schema=None):
     password = db_settings.get('PASSWORD')
     host = db_settings.get('HOST', 'localhost')
     port = db_settings.get('PORT', 5432)
+    if PGBOUNCER:
+        host = PGBOUNCER.get('HOST', host)
+        port = PGBOUNCER.get('PORT', 6432)
     return OSGEOManager.build_connection_string(db_name, schema, user, password, port, host)
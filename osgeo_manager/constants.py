@@ -33,3 +33,18 @@ TEMP_DIR_PATH = os.path.join(
     os.path.dirname(os.path.realpath(__file__)), 'tmp_generator')
 DOWNLOADS_DIR_PATH = os.path.join(
     os.path.dirname(os.path.realpath(__file__)), 'downloads')
+GDAL_CONFIG_OPTIONS = {
+    'GDAL_CACHEMAX': '1024',
+    'VSI_CACHE': 'YES',
+    'VSI_CACHE_SIZE': '134217728',
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'TRUE',
+    'OGR_GPKG_NUM_THREADS': 'ALL_CPUS',
+}
+SLD_FETCH_WORKERS = 8
+COPY_LAYER_WORKERS = 8
+PGBOUNCER = getattr(settings, 'OSGEO_MANAGER_PGBOUNCER', None)
+LAYERS_CHUNK_SIZE = 2000
+BACKUP_JOURNAL_DIR = os.path.join(TEMP_DIR_PATH, 'backup_journals')
+# unfinished backups older than this (seconds) are started over
+BACKUP_JOURNAL_MAX_AGE = getattr(
+    settings, 'OSGEO_MANAGER_BACKUP_JOURNAL_MAX_AGE', 24 * 60 * 60)
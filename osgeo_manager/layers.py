@@ -213,3 +213,19 @@ class OSGEOLayer(object):
             'metadata_dict': feature.items(),
             'geometry': feature.geometry()
         } for feature in self.gpkg_layer]
+
+    def get_arrow_batches(self, batch_size=65536, read_geometry=True):
+        # needs GDAL >= 3.6 and pyarrow, features are converted in bulk
+        # by GDAL instead of field by field in python
+        self.gpkg_layer.ResetReading()
+        if not read_geometry:
+            self.gpkg_layer.SetIgnoredFields(['OGR_GEOMETRY'])
+        try:
+            stream = self.gpkg_layer.GetArrowStreamAsPyArrow(
+                ['MAX_FEATURES_IN_BATCH={}'.format(batch_size)])
+            for batch in stream:
+                yield batch
+        finally:
+            stream = None
+            if not read_geometry:
+                self.gpkg_layer.SetIgnoredFields([])
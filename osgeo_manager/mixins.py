@@ -1,4 +1,5 @@
-from contextlib import contextmanager
+from collections import Counter
+from itertools import chain
 
 from .constants import STYLES_TABLE
 from .utils import is_postgres_source
@@ -8,6 +9,30 @@ except ImportError:
     import ogr
 
 
+class OSGEOSource(object):
+    def __init__(self, source_path, update_enabled=0):
+        self.path = source_path
+        self.update_enabled = update_enabled
+        self._source = None
+
+    @property
+    def source(self):
+        if self._source is None:
+            self._source = ogr.Open(self.path, self.update_enabled)
+        return self._source
+
+    def __enter__(self):
+        return self.source
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._source:
+            self._source.FlushCache()
+        self._source = None
+
+
 class OSGEOManagerMixin(object):
     @staticmethod
     def build_connection_string(DB_Name,
@@ -20,12 +45,10 @@ class OSGEOManagerMixin(object):
         return connectionString
 
     @staticmethod
-    @contextmanager
     def open_source(source_path, update_enabled=0):
-        source = ogr.Open(source_path, update_enabled)
-        yield source
-        source.FlushCache()
-        source = None
+        # OGR data sources aren't thread safe and cache their table list,
+        # every call gets its own, connection reuse is left to PgBouncer
+        return OSGEOSource(source_path, update_enabled)
 
     @staticmethod
     def source_layer_exists(source, layername):
@@ -34,6 +57,13 @@ class OSGEOManagerMixin(object):
             return True
         return False
 
+    @staticmethod
+    def get_source_layer_names(source):
+        return {
+            source.GetLayer(i).GetName(): i
+            for i in range(source.GetLayerCount())
+        }
+
     @classmethod
     def read_source_schema(cls, source):
         layers = cls.get_source_layers(source)
@@ -43,9 +73,9 @@ class OSGEOManagerMixin(object):
 
     @staticmethod
     def get_source_layers(source):
-        from .layer_manager import GpkgLayer
+        from .layers import OSGEOLayer
         return [
-            GpkgLayer(layer, source) for layer in source
+            OSGEOLayer(layer, source) for layer in source
             if layer.GetName() != STYLES_TABLE
         ]
 
@@ -55,22 +85,28 @@ class OSGEOManagerMixin(object):
         schema2 = layer2.get_full_schema()
         if ignore_case:
             schema1 = [(field[0].lower(), field[1], field[2])
-                       for field in layer1.get_full_schema()]
+                       for field in schema1]
             schema2 = [(field[0].lower(), field[1], field[2])
-                       for field in layer2.get_full_schema()]
-        schema1.sort(key=lambda field: field[0])
-        schema2.sort(key=lambda field: field[0])
-        new_fields = [field for field in schema1 if field not in schema2]
-        deleted_fields = [field for field in schema2 if field not in schema1]
-        deleted_fields.sort(key=lambda field: field[0])
-        new_fields.sort(key=lambda field: field[0])
+                       for field in schema2]
+        fields1 = frozenset(schema1)
+        fields2 = frozenset(schema2)
         return {
-            "compatible": schema1 == schema2,
-            "deleted_fields": deleted_fields,
-            "new_fields": new_fields,
+            # fields differing only by case collapse in the sets
+            # when ignore_case is set, so compare with multiplicity
+            "compatible": Counter(schema1) == Counter(schema2),
+            "deleted_fields": sorted(fields2 - fields1),
+            "new_fields": sorted(fields1 - fields2),
         }
 
     @staticmethod
     def get_layers_features(layers):
         for lyr in layers:
             yield lyr.get_features()
+
+    @staticmethod
+    def get_layers_arrow_batches(layers, batch_size=65536,
+                                 read_geometry=True):
+        return chain.from_iterable(
+            lyr.get_arrow_batches(
+                batch_size=batch_size, read_geometry=read_geometry)
+            for lyr in layers)
@@ -4,15 +4,20 @@ import os
 import sys
 import time
 import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
+from functools import lru_cache
 from io import BytesIO
 
-import lxml
+import lxml.etree
 import requests
 from django.conf import settings
 from django.contrib.gis.geos import Polygon
 from django.utils.translation import ugettext as _
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
 
 from geonode.geoserver.helpers import (cascading_delete, get_store, gs_catalog,
                                        ogc_server_settings,
@@ -30,6 +35,10 @@ try:
 except ImportError:
     from .log import get_logger
 logger = get_logger(__name__)
+# matches ogc:PropertyName and sld:PropertyName in a single pass
+_PROP_XPATH = lxml.etree.XPath("//*[local-name()='PropertyName']")
+# SLDs repeat the same attribute names over and over
+_slug = lru_cache(maxsize=4096)(SLUGIFIER)
 
 
 class GeoserverPublisher(object):
@@ -49,24 +58,35 @@ class GeoserverPublisher(object):
                                            ogc_server_settings.credentials[0])
         self.password = geoserver_user.get('password',
                                            ogc_server_settings.credentials[1])
+        self.featureTypes_url = urljoin(self.base_url, "rest/workspaces/",
+                                        self.workspace, "datastores/",
+                                        self.datastore, "featuretypes")
+        self.gwc_url = urljoin(self.base_url, "gwc/rest/")
+        self._auth = HTTPBasicAuth(self.username, self.password)
+        self._session = requests.Session()
+        self._session.auth = self._auth
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=32,
+            max_retries=Retry(total=3, backoff_factor=0.2))
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
 
-    @property
-    def featureTypes_url(self):
-        return urljoin(self.base_url, "rest/workspaces/", self.workspace,
-                       "datastores/", self.datastore, "featuretypes")
+    def close(self):
+        self._session.close()
 
-    @property
-    def gwc_url(self):
-        return urljoin(self.base_url, "gwc/rest/")
+    def __del__(self):
+        # __init__ may have failed before the session was created
+        if hasattr(self, '_session'):
+            self.close()
 
     def get_gwc_layer_url(self, layername):
         return urljoin(self.gwc_url, "layers", layername)
 
     def publish_postgis_layer(self, tablename, layername):
-        req = requests.post(
+        req = self._session.post(
             self.featureTypes_url,
             headers={'Content-Type': "application/json"},
-            auth=HTTPBasicAuth(self.username, self.password),
             json={"featureType": {
                 "name": layername,
                 "nativeName": tablename
@@ -78,6 +98,33 @@ class GeoserverPublisher(object):
             return True
         return False
 
+    def publish_postgis_layers(self, pairs, max_workers=8):
+        published = {}
+        if not pairs:
+            return published
+        # results are keyed by layer name, a repeated name would silently
+        # drop the outcome of one of its publish requests
+        counts = Counter(layername for tablename, layername in pairs)
+        duplicates = sorted(name for name, count in counts.items()
+                            if count > 1)
+        if duplicates:
+            raise ValueError("duplicate layer names: {}".format(
+                ", ".join(duplicates)))
+        with ThreadPoolExecutor(
+                max_workers=min(max_workers, len(pairs))) as executor:
+            futures = {
+                layername: executor.submit(self.publish_postgis_layer,
+                                           tablename, layername)
+                for tablename, layername in pairs
+            }
+            for layername, future in futures.items():
+                try:
+                    published[layername] = future.result()
+                except Exception as e:
+                    logger.error(e)
+                    published[layername] = False
+        return published
+
     def delete_layer(self, layername):
         try:
             cascading_delete(gs_catalog, "{}:{}".format(
@@ -88,11 +135,12 @@ class GeoserverPublisher(object):
     def upload_file(self, file, rel_path=ICON_REL_PATH):
         url = urljoin(self.base_url, "rest/", "resource", rel_path,
                       os.path.basename(file.name))
-        req = requests.put(
+        # stream from the file object instead of reading it into memory,
+        # requests takes Content-Length from the file itself
+        req = self._session.put(
             url,
-            data=file.read(),
-            headers={'Content-Type': 'application/octet-stream'},
-            auth=HTTPBasicAuth(self.username, self.password))
+            data=file,
+            headers={'Content-Type': 'application/octet-stream'})
         message = "URL:{} STATUS:".format(url, req.status_code)
         logger.error(message)
         if req.status_code == 201:
@@ -110,17 +158,12 @@ class GeoserverPublisher(object):
             return "{}_{}".format(sld_name, timestr)
 
     def convert_sld_attributes(self, sld_path):
-        tree = lxml.etree.parse(sld_path)
-        root = tree.getroot()
-        nsmap = {k: v for k, v in root.nsmap.items() if k}
-        properties = tree.xpath('.//ogc:PropertyName', namespaces=nsmap)
-        for prop in properties:
-            value = SLUGIFIER(str(prop.text))
-            prop.text = value
-        properties = tree.xpath('.//sld:PropertyName', namespaces=nsmap)
-        for prop in properties:
-            value = SLUGIFIER(str(prop.text))
-            prop.text = value
+        parser = lxml.etree.XMLParser(collect_ids=False, huge_tree=False)
+        tree = lxml.etree.parse(sld_path, parser)
+        for prop in _PROP_XPATH(tree):
+            if prop.text is None:
+                continue
+            prop.text = _slug(prop.text)
         return lxml.etree.tostring(tree)
 
     def create_style(self, name, sld_path, overwrite=True, raw=True):
@@ -214,14 +257,17 @@ class GeonodePublisher(object):
             layer.save()
             logger.warning("=========> Fixing Metadata Links")
             # Fix metadata links if the ip has changed
-            if layer.link_set.metadata().count() > 0:
+            meta_links = list(layer.link_set.metadata())
+            if len(meta_links) > 0:
                 if not created and settings.SITEURL \
-                        not in layer.link_set.metadata()[0].url:
+                        not in meta_links[0].url:
                     layer.link_set.metadata().delete()
                     layer.save()
-                    metadata_links = []
-                    for link in layer.link_set.metadata():
-                        metadata_links.append((link.mime, link.name, link.url))
+                    # saving the layer regenerates the links, read them again
+                    metadata_links = [
+                        (link.mime, link.name, link.url)
+                        for link in layer.link_set.metadata()
+                    ]
                     resource.metadata_links = metadata_links
                     gs_catalog.save(resource)
 
@@ -43,6 +43,9 @@ class LayerStyle(object):
 
 class StyleManager(object):
     styles_table_name = 'layer_styles'
+    insert_style_sql = ('INSERT INTO {} (f_table_name,f_geometry_column,'
+                        'styleName,styleSLD,useAsDefault) '
+                        'VALUES (?,?,?,?,?);')
 
     def __init__(self, gpkg_path):
         self.db_path = gpkg_path
@@ -181,10 +184,20 @@ class StyleManager(object):
         with self.db_session() as session:
             cursor = session.cursor()
             cursor.execute(
-                'INSERT INTO {} (f_table_name,f_geometry_column,styleName,styleSLD,useAsDefault) VALUES (?,?,?,?,?);'.
-                format(self.styles_table_name),
+                self.insert_style_sql.format(self.styles_table_name),
                 (layername, geom_field, stylename, sld_body, default))
             session.commit()
             return cursor.lastrowid
 
-    # TODO: add_styles with executemany
+    @table_exists_decorator(failure_result=None)
+    def add_styles_bulk(self, rows, default=False, replace=False):
+        # one transaction for all the styles instead of one per style
+        with self.db_session() as session:
+            cursor = session.cursor()
+            if replace:
+                cursor.execute('DELETE FROM {}'.format(self.styles_table_name))
+            cursor.executemany(
+                self.insert_style_sql.format(self.styles_table_name),
+                (tuple(row) + (default, ) for row in rows))
+            session.commit()
+            return cursor.rowcount
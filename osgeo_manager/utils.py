@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import collections
+import re
 
 import requests
 from requests.auth import HTTPBasicAuth
@@ -64,3 +65,8 @@ def read_in_chunks(obj, chunk_size=2048):
 
 def is_postgres_source(source_path):
     return PG_REGEX.match(source_path)
+
+
+def launder_pg_name(name):
+    # mirrors the OGR PostgreSQL driver LAUNDER=YES behaviour
+    return re.sub(r"['\-# ]", '_', name.lower())[:63]